@@ -4,16 +4,21 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
+
+from shared_state import SQLiteChatMessageHistory, session_lock, session_dir, create_job, update_job
 
 
 from langchain.tools import tool
 from langchain.agents import create_agent
 from langchain.agents.structured_output import ToolStrategy
+from langchain.agents.middleware import wrap_model_call
+
+from llm_scheduler import scheduler, usage_callback, call_with_retry, llm_priority, deck_budget, TokenBudgetExceeded
 
 import os
 import sys
 from typing import List
+from contextvars import ContextVar
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -23,8 +28,11 @@ load_dotenv()
 # load_dotenv(dotenv_path=DOTENV_PATH)
 
 # llm = ChatGoogleGenerativeAI(model="models/gemini-3-pro-preview", temperature=0.7)
+# All calls go through the shared scheduler (rate limits, priorities, deck budget); retries are done by
+# `call_with_retry` with jittered backoff, so the client's own retries are turned off.
 llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-pro", temperature=0.7, api_key=os.getenv("GOOGLE_API_KEY"))
+    model="gemini-2.5-pro", temperature=0.7, api_key=os.getenv("GOOGLE_API_KEY"),
+    rate_limiter=scheduler, callbacks=[usage_callback], max_retries=1)
 
 # Create a local temp directory if not exists
 TEMP_DIR = os.getenv("TEMP_DIR", "/tmp")
@@ -37,6 +45,27 @@ PPT_PPT_FILE = os.getenv("PPT_PPT_FILE", "/tmp/generated_presentation.pptx")
 # PPTX_CODE = "/tmp/generated_ppt_code.py"
 # PPT_FILE_NAME = "/tmp/output.pptx"
 
+# Session and job of the turn being run. Tools use them to pick per-session/per-job files,
+# so workers don't overwrite each other and every turn keeps its own deck.
+current_session: ContextVar[str | int | None] = ContextVar(
+    "current_session", default=None)
+current_job: ContextVar[int | None] = ContextVar("current_job", default=None)
+
+
+def get_ppt_code_file() -> str:
+    session_id = current_session.get()
+    if session_id is None:
+        return PPT_CODE_FILE
+    return os.path.join(session_dir(session_id), os.path.basename(PPT_CODE_FILE))
+
+
+def get_ppt_file() -> str:
+    session_id = current_session.get()
+    job_id = current_job.get()
+    if session_id is None or job_id is None:
+        return PPT_PPT_FILE
+    return os.path.join(session_dir(session_id), f"{job_id}.pptx")
+
 # ## PPT code gen:
 
 CONTEXT_DOCS_PATH = os.path.join("pptx_docs", "merged_docs_edit.md")
@@ -106,13 +135,13 @@ def create_ppt_tool(topic: str, others: str | None, slide_count: int | None) ->
     """
     slide_count = slide_count if slide_count else 10
 
-    resp = ppt_generation_chain.invoke({  # type: ignore
+    resp = call_with_retry(lambda: ppt_generation_chain.invoke({  # type: ignore
         "user_query": topic,
         "target_slides": f"{slide_count}",
         "context_docs_dump": CONTEXT_DOCS,
         "other_details": others if others else "Nothing.",
-        "pptx_file": PPT_PPT_FILE
-    })
+        "pptx_file": get_ppt_file()
+    }))
     saved_resp = resp  # debugging purpose
     resp = resp.text
     try:
@@ -137,14 +166,15 @@ def execute_code_tool(code: str) -> str:
     Returns:
         str: The output message from the execution.
     """
-    with open(PPT_CODE_FILE, "w", encoding="utf-8") as f:
+    code_file = get_ppt_code_file()
+    with open(code_file, "w", encoding="utf-8") as f:
         f.write(code)
 
     import subprocess
     try:
         result = subprocess.run(
             # ["python", PPT_FILE_NAME],
-            [sys.executable, PPT_CODE_FILE],
+            [sys.executable, code_file],
             capture_output=True,
             text=True,
             check=True
@@ -197,15 +227,15 @@ def debug_code_tool(error_message: str, ppt_topic: str) -> str:
         str: New code to save and execute.
     """
     wrong_code = ""
-    with open(PPT_CODE_FILE, "r", encoding="utf-8") as f:
+    with open(get_ppt_code_file(), "r", encoding="utf-8") as f:
         wrong_code = f.read()
 
-    resp = code_debug_chain.invoke({  # type: ignore
+    resp = call_with_retry(lambda: code_debug_chain.invoke({  # type: ignore
         "code_block": wrong_code,
         "error_message": error_message,
         "context_docs_dump": CONTEXT_DOCS,
         "user_query": ppt_topic
-    })
+    }))
     resp = resp.text
     saved_resp = resp  # debugging purpose
 
@@ -228,12 +258,19 @@ class PPTAgentResp(BaseModel):
         ..., description="If ppt_generated is False, this field contains the follow up question or error details. If ppt_generated is True, this field contains 'Done' or 'Failed'.")
 
 
+@wrap_model_call
+def retry_model_call(request, handler):
+    # Same retry policy for the agent's own model calls as for the tool chains.
+    return call_with_retry(lambda: handler(request))
+
+
 ppt_maker_agent = create_agent(
     name="PPT Maker Agent",
     model=llm,
     system_prompt="You are an expert in making PPTs for any given topic. You can ask follow up questions to clarify user requirements before generating the PPT. You will be provided with some tools to help you generate the PPTs effectively. You can use them multiple times as needed. At the end of your work, return the response to user properly.",
     tools=[create_ppt_tool, execute_code_tool, debug_code_tool],
     response_format=ToolStrategy(PPTAgentResp),
+    middleware=[retry_model_call],
 )
 
 
@@ -242,14 +279,9 @@ ppt_maker_agent = create_agent(
 
 # from langchain_core.runnables.history import RunnableWithMessageHistory
 
-store = {}
-
-
 def get_session_history(session_id: str | int) -> BaseChatMessageHistory:
-    session_id = int(session_id)
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
+    # Stored in the shared SQLite db (see shared_state.py), so any uvicorn worker can continue the session.
+    return SQLiteChatMessageHistory(int(session_id))
 
 
 def get_chat_history(session_id: str | int) -> List:
@@ -275,34 +307,67 @@ def add_message_to_history(session_id: str | int, message: str, type: str) -> No
         history.add_ai_message(message=message)
 
 
-def ask_something(session_id: str | int, user_input: str, verbose: bool = False) -> PPTAgentResp:
+def ask_something(session_id: str | int, user_input: str, verbose: bool = False, priority: str = "interactive", lock_timeout: float | None = None) -> tuple[PPTAgentResp, int]:
     """Main function to continue any past chat session or start a new one.
 
     Arguments:
         session_id (str | int): Unique identifier for the chat session.
         user_input (str): The user's input message. Or follow up answer.
+        priority (str): "interactive" (served first) or "batch" for the LLM scheduler.
+        lock_timeout (optional, float): Seconds to wait while the session is busy. Defaults to `LOCK_TIMEOUT`.
+    Returns:
+        tuple[PPTAgentResp, int]: The agent's answer and the id of the job recorded for this turn.
     """
-    history = get_session_history(session_id)
-
-    agent_response = ppt_maker_agent.invoke(
-        input={
-            "messages": history.messages + [HumanMessage(content=user_input)]
-        },  # type: ignore
-        verbose=verbose
-    )
-
-    final_response: PPTAgentResp = agent_response['structured_response']
-
-    # Update history
-    add_message_to_history(session_id, user_input, "human")
-    add_message_to_history(session_id, final_response.content, "ai")
+    # One turn at a time per session, across all workers.
+    with session_lock(session_id, timeout=lock_timeout):
+        job_id = create_job(session_id, topic=user_input)
+        session_token = current_session.set(session_id)
+        job_token = current_job.set(job_id)
+        try:
+            history = get_session_history(session_id)
+            ppt_file = get_ppt_file()
+
+            budget_hit = False
+            try:
+                with llm_priority(priority), deck_budget():
+                    agent_response = ppt_maker_agent.invoke(
+                        input={
+                            "messages": history.messages + [HumanMessage(content=user_input)]
+                        },  # type: ignore
+                        verbose=verbose
+                    )
+                final_response: PPTAgentResp = agent_response['structured_response']
+            except TokenBudgetExceeded as e:
+                # Stop the turn instead of letting the agent keep retrying/debugging.
+                budget_hit = True
+                final_response = PPTAgentResp(
+                    ppt_generated=False, content=f"Stopped early: {e} Please try again with a simpler request.")
+
+            # Update history
+            add_message_to_history(session_id, user_input, "human")
+            add_message_to_history(session_id, final_response.content, "ai")
+
+            if final_response.ppt_generated and os.path.exists(ppt_file):
+                update_job(job_id, "done", artifact_path=ppt_file)
+            elif final_response.ppt_generated:
+                update_job(job_id, "failed",
+                           detail=f"Agent reported the presentation as generated, but {ppt_file} was not written.")
+            else:
+                update_job(job_id, "failed" if budget_hit else "pending",
+                           detail=final_response.content)
+        except Exception as e:
+            update_job(job_id, "failed", detail=str(e))
+            raise
+        finally:
+            current_job.reset(job_token)
+            current_session.reset(session_token)
 
     # Answer:
-    return final_response
+    return final_response, job_id
 
 
 if __name__ == "__main__":
     # ans = ask_something(10, "Hello")
-    ans = ask_something(
+    ans, job_id = ask_something(
         session_id=10, verbose=True, user_input="No counter question, just one simple page saying 'please!!!'")
-    print(ans.ppt_generated, ans.content)
+    print(job_id, ans.ppt_generated, ans.content)
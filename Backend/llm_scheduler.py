@@ -0,0 +1,378 @@
+import os
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, List, TypeVar
+
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.messages import BaseMessage
+from dotenv import load_dotenv
+
+from shared_state import shared_db
+
+try:
+    import httpx
+except ImportError:  # only used to recognise timeouts
+    httpx = None
+load_dotenv()
+
+
+# Central scheduler for outbound Gemini calls.
+# It is plugged into the chat model as its `rate_limiter` (admission: RPM/TPM buckets, priorities, deck budget)
+# and as a callback (estimates the prompt before the call, corrects with the real usage once it finishes),
+# so every call made through `llm`
+# - the generation/debug chains and the agent itself - goes through the same queue.
+# Buckets, queue and counters live in the shared SQLite db (shared_state.py), so the limits and
+# stats cover all uvicorn workers together, not each process separately.
+
+LLM_RPM = float(os.getenv("LLM_RPM", "60"))
+LLM_TPM = float(os.getenv("LLM_TPM", "1000000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "2"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "60"))
+LLM_POLL_INTERVAL = float(os.getenv("LLM_POLL_INTERVAL", "0.05"))
+# Tokens reserved on admission: estimated from the prompt (chars / LLM_CHARS_PER_TOKEN + expected output),
+# or LLM_TOKENS_PER_CALL when the prompt was not seen.
+LLM_TOKENS_PER_CALL = int(os.getenv("LLM_TOKENS_PER_CALL", "20000"))
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "4"))
+LLM_OUTPUT_TOKEN_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKEN_ESTIMATE", "4000"))
+DECK_TOKEN_BUDGET = int(os.getenv("DECK_TOKEN_BUDGET", "300000"))
+
+# Lower value = served first.
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+
+
+class TokenBudgetExceeded(RuntimeError):
+    """Raised before an LLM call when the current deck has used up its token budget."""
+
+
+class TokenBudget:
+    """Tokens spent on one deck (one agent turn), shared by all LLM calls made for it."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def charge(self, tokens: int) -> None:
+        with self._lock:
+            self.used += tokens
+
+    @property
+    def exhausted(self) -> bool:
+        return self.limit > 0 and self.used >= self.limit
+
+
+current_priority: ContextVar[str] = ContextVar(
+    "current_priority", default="interactive")
+current_budget: ContextVar[TokenBudget | None] = ContextVar(
+    "current_budget", default=None)
+# Per-call token bookkeeping between the callback and the rate limiter (both run in the caller's context):
+# the estimate for the call about to be admitted, and what was reserved for the call in flight.
+_call_estimate: ContextVar[int | None] = ContextVar(
+    "_call_estimate", default=None)
+_call_reservation: ContextVar[int] = ContextVar(
+    "_call_reservation", default=0)
+
+
+@contextmanager
+def llm_priority(priority: str):
+    """Run the LLM calls inside the block with the given priority ("interactive" | "batch")."""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}")
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+@contextmanager
+def deck_budget(limit: int | None = None):
+    """Give the LLM calls inside the block a shared token budget (default `DECK_TOKEN_BUDGET`). A limit <= 0 means unlimited."""
+    budget = TokenBudget(DECK_TOKEN_BUDGET if limit is None else limit)
+    token = current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        current_budget.reset(token)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class LLMScheduler(BaseRateLimiter):
+    """Admits LLM calls by priority once the request-per-minute and token-per-minute buckets allow it.
+
+    On admission one request and the estimated tokens of the call are reserved, so a burst of calls
+    is spread out before anything reaches the provider. `TokenUsageCallback` later replaces the
+    reservation with the real usage. All state is kept in the shared database, so every worker
+    draws from the same buckets and queue.
+    """
+
+    def __init__(self, requests_per_minute: float = LLM_RPM, tokens_per_minute: float = LLM_TPM,
+                 tokens_per_call: int = LLM_TOKENS_PER_CALL):
+        self.capacity = {"requests": requests_per_minute,
+                         "tokens": tokens_per_minute}
+        self.tokens_per_call = tokens_per_call
+
+    # Buckets are refilled continuously up to `capacity` per minute and may go negative (debt).
+    def _level(self, conn: sqlite3.Connection, name: str, now: float) -> float:
+        capacity = self.capacity[name]
+        row = conn.execute("SELECT level, updated_at FROM llm_buckets WHERE name = ?",
+                           (name,)).fetchone()
+        if row is None:
+            return capacity
+        return min(capacity, row["level"] + (now - row["updated_at"]) * capacity / 60.0)
+
+    def _set_level(self, conn: sqlite3.Connection, name: str, level: float, now: float) -> None:
+        conn.execute("INSERT OR REPLACE INTO llm_buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                     (name, level, now))
+
+    def _wait_time(self, name: str, level: float, amount: float) -> float:
+        """Seconds until `amount` is available in the bucket (0 if it is already)."""
+        if level >= amount:
+            return 0.0
+        return (amount - level) * 60.0 / self.capacity[name]
+
+    @staticmethod
+    def _add_stat(conn: sqlite3.Connection, name: str, value: float, use_max: bool = False) -> None:
+        update = "MAX(value, excluded.value)" if use_max else "value + excluded.value"
+        conn.execute(f"INSERT INTO llm_stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = {update}",
+                     (name, value))
+
+    @staticmethod
+    def _queue_head(conn: sqlite3.Connection) -> sqlite3.Row:
+        return conn.execute(
+            "SELECT id, worker_pid FROM llm_queue ORDER BY priority, id LIMIT 1").fetchone()
+
+    def _wait_for_head(self, entry_id: int, blocking: bool) -> bool:
+        """Wait until `entry_id` is first in the queue, with plain reads (no write lock) while it isn't."""
+        while True:
+            with shared_db() as conn:
+                head = self._queue_head(conn)
+            if head["id"] == entry_id:
+                return True
+            if not _pid_alive(head["worker_pid"]):
+                # Left behind by a worker that died while waiting.
+                with shared_db() as conn:
+                    conn.execute("DELETE FROM llm_queue WHERE worker_pid = ?",
+                                 (head["worker_pid"],))
+                continue
+            if not blocking:
+                return False
+            time.sleep(LLM_POLL_INTERVAL)
+
+    def _try_admit(self, entry_id: int, start: float, reserve: int) -> tuple[bool, float, bool]:
+        """One admission attempt under the write lock. Returns (admitted, seconds to wait, whether this entry is at the head)."""
+        with shared_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                head = self._queue_head(conn)
+                now = time.time()
+                requests = self._level(conn, "requests", now)
+                tokens = self._level(conn, "tokens", now)
+                # A call larger than the whole bucket only waits for a full bucket, so it can't starve.
+                wait = max(self._wait_time("requests", requests, 1),
+                           self._wait_time("tokens", tokens, min(reserve, self.capacity["tokens"])))
+                is_head = head["id"] == entry_id
+                if is_head and wait == 0:
+                    self._set_level(conn, "requests", requests - 1, now)
+                    self._set_level(conn, "tokens", tokens - reserve, now)
+                    conn.execute("DELETE FROM llm_queue WHERE id = ?", (entry_id,))
+                    waited = time.monotonic() - start
+                    self._add_stat(conn, "admitted", 1)
+                    self._add_stat(conn, "wait_total", waited)
+                    self._add_stat(conn, "wait_max", waited, use_max=True)
+                    conn.execute("COMMIT")
+                    return True, 0.0, True
+                conn.execute("COMMIT")
+                return False, wait, is_head
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        budget = current_budget.get()
+        if budget is not None and budget.exhausted:
+            with shared_db() as conn:
+                self._add_stat(conn, "budget_stops", 1)
+            raise TokenBudgetExceeded(
+                f"Token budget for this deck is used up ({budget.used}/{budget.limit} tokens).")
+
+        estimate = _call_estimate.get()
+        _call_estimate.set(None)
+        reserve = self.tokens_per_call if estimate is None else estimate
+
+        start = time.monotonic()
+        with shared_db() as conn:
+            entry_id = conn.execute(
+                "INSERT INTO llm_queue (priority, worker_pid, enqueued_at) VALUES (?, ?, ?)",
+                (PRIORITIES[current_priority.get()], os.getpid(), time.time())).lastrowid
+        admitted = False
+        try:
+            while True:
+                # Only the head of the queue takes the write lock; the others just read their position.
+                if not self._wait_for_head(entry_id, blocking):
+                    return False
+                admitted, wait, is_head = self._try_admit(
+                    entry_id, start, reserve)
+                if admitted:
+                    _call_reservation.set(reserve)
+                    return True
+                if not blocking:
+                    return False
+                # The head sleeps until the buckets refill (a higher-priority call may have overtaken it).
+                if is_head:
+                    time.sleep(min(max(wait, LLM_POLL_INTERVAL), 1.0))
+        finally:
+            if not admitted:
+                with shared_db() as conn:
+                    conn.execute("DELETE FROM llm_queue WHERE id = ?", (entry_id,))
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        return await asyncio.to_thread(self.acquire, blocking=blocking)
+
+    def record_usage(self, tokens: int, reserved: int = 0) -> None:
+        """Charge `tokens` actually used by a call, returning the `reserved` estimate taken on admission."""
+        with shared_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            self._set_level(conn, "tokens", self._level(
+                conn, "tokens", now) - tokens + reserved, now)
+            self._add_stat(conn, "tokens_used", tokens)
+            conn.execute("COMMIT")
+        budget = current_budget.get()
+        if budget is not None:
+            budget.charge(tokens)
+
+    def record_retry(self) -> None:
+        with shared_db() as conn:
+            self._add_stat(conn, "retries", 1)
+
+    def stats(self) -> dict:
+        """Queue depth, wait times and bucket levels across all workers, for capacity sizing."""
+        with shared_db() as conn:
+            now = time.time()
+            counters = {row["name"]: row["value"]
+                        for row in conn.execute("SELECT name, value FROM llm_stats")}
+            queued = {row["priority"]: row["n"] for row in conn.execute(
+                "SELECT priority, COUNT(*) AS n FROM llm_queue GROUP BY priority")}
+            requests = self._level(conn, "requests", now)
+            tokens = self._level(conn, "tokens", now)
+        admitted = int(counters.get("admitted", 0))
+        return {
+            "scope": "all workers",
+            "worker_pid": os.getpid(),
+            "queue_depth": sum(queued.values()),
+            "queue_depth_by_priority": {name: queued.get(value, 0)
+                                        for name, value in PRIORITIES.items()},
+            "admitted": admitted,
+            "wait_avg_seconds": counters.get("wait_total", 0.0) / admitted if admitted else 0.0,
+            "wait_max_seconds": counters.get("wait_max", 0.0),
+            "retries": int(counters.get("retries", 0)),
+            "budget_stops": int(counters.get("budget_stops", 0)),
+            "tokens_used": int(counters.get("tokens_used", 0)),
+            "requests_available": requests,
+            "tokens_available": tokens,
+        }
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Estimates every LLM call before admission and charges its real usage to the scheduler and deck budget."""
+
+    def __init__(self, scheduler: LLMScheduler):
+        self.scheduler = scheduler
+
+    def on_chat_model_start(self, serialized: dict, messages: List[List[BaseMessage]], **kwargs: Any) -> None:
+        # Runs before the model's rate limiter; the estimate is picked up by `LLMScheduler.acquire`.
+        chars = sum(len(str(msg.content)) for batch in messages for msg in batch)
+        _call_estimate.set(int(chars / LLM_CHARS_PER_TOKEN) + LLM_OUTPUT_TOKEN_ESTIMATE)
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        reserved = _call_reservation.get()
+        _call_reservation.set(0)
+        if reserved:
+            self.scheduler.record_usage(0, reserved=reserved)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        tokens = 0
+        for generations in response.generations:
+            for gen in generations:
+                usage = getattr(getattr(gen, "message", None),
+                                "usage_metadata", None)
+                if usage:
+                    tokens += usage.get("total_tokens", 0)
+        if not tokens and response.llm_output:
+            usage = response.llm_output.get("usage_metadata") or {}
+            tokens = usage.get("total_tokens", 0)
+        reserved = _call_reservation.get()
+        _call_reservation.set(0)
+        if not tokens:
+            tokens = reserved  # usage not reported; keep the estimate
+        if tokens or reserved:
+            self.scheduler.record_usage(tokens, reserved=reserved)
+
+
+def _error_chain(error: BaseException):
+    # The Gemini client's errors are often wrapped by langchain; look at the causes too.
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Rate limits, 5xx responses and timeouts from the provider are worth retrying; everything else is not."""
+    if isinstance(error, TokenBudgetExceeded):
+        return False
+    for exc in _error_chain(error):
+        # google.genai.errors.APIError and google.api_core exceptions carry the HTTP status as `code`.
+        for attr in ("code", "status_code"):
+            code = getattr(exc, attr, None)
+            if isinstance(code, int) and not isinstance(code, bool) and code in RETRYABLE_STATUS_CODES:
+                return True
+        if isinstance(exc, TimeoutError) or (httpx is not None and isinstance(exc, httpx.TimeoutException)):
+            return True
+        # Narrow fallback for provider errors that only report the quota status in their message.
+        module = type(exc).__module__ or ""
+        if module.startswith(("google", "langchain_google_genai")) and "RESOURCE_EXHAUSTED" in str(exc):
+            return True
+    return False
+
+
+def call_with_retry(fn: Callable[[], T], max_retries: int = LLM_MAX_RETRIES) -> T:
+    """Call `fn`, retrying retryable errors with exponential backoff and full jitter."""
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            scheduler.record_retry()
+            delay = min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+
+scheduler = LLMScheduler()
+usage_callback = TokenUsageCallback(scheduler)
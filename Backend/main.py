@@ -5,7 +5,9 @@ import uvicorn
 from fastapi import FastAPI, Form, HTTPException
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from agents import ask_something, PPTAgentResp, PPT_PPT_FILE
+from agents import ask_something, PPTAgentResp
+from shared_state import get_job, list_jobs, SessionLockTimeout, HTTP_LOCK_TIMEOUT
+from llm_scheduler import scheduler, PRIORITIES
 import os
 from dotenv import load_dotenv
 load_dotenv()
@@ -36,23 +38,32 @@ async def root():
 
 
 @app.post("/generate")
-async def generate_presentation(topic: str = Form(...)):
+def generate_presentation(topic: str = Form(...), session_id: int = Form(1),
+                          priority: str = Form("interactive", description="LLM scheduling priority: interactive | batch")):
     """
     Receives a topic, generates a presentation, and returns it.
+    Batch callers pass priority="batch" so interactive turns are served first by the LLM scheduler.
     """
-    session_id = 1  # Using a single session for now
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=422, detail=f"priority must be one of: {', '.join(PRIORITIES)}")
+    # Sync endpoint: runs in the threadpool, so a long agent turn doesn't block the worker's event loop.
     try:
         # This function will trigger the agent chain which creates and saves the pptx file.
-        result = ask_something(session_id, topic)
+        result, job_id = ask_something(
+            session_id, topic, priority=priority, lock_timeout=HTTP_LOCK_TIMEOUT)
 
         if result.ppt_generated:
-            if os.path.exists(PPT_PPT_FILE):
+            # Serve this turn's own deck; later turns write to their own files and never replace it.
+            job = get_job(job_id)
+            ppt_file = job["artifact_path"] if job else None
+            if ppt_file and os.path.exists(ppt_file):
                 # Return the pptx file as a response
                 return FileResponse(
-                    PPT_PPT_FILE,
+                    ppt_file,
                     media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation",
                     filename="output.pptx",
-                    headers={"status": "true", "content": str(result.content)}
+                    headers={"status": "true", "content": str(result.content), "job_id": str(job_id)}
                 )
             else:
                 raise HTTPException(
@@ -60,6 +71,10 @@ async def generate_presentation(topic: str = Form(...)):
         else:
             return {"status": False, "content": result.content}
 
+    except HTTPException:
+        raise
+    except SessionLockTimeout as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"An error occurred: {str(e)}")
@@ -68,8 +83,9 @@ async def generate_presentation(topic: str = Form(...)):
 # New endpoint to get session history by session_id
 
 
+# Plain `def` endpoints below run their blocking SQLite queries in the threadpool, not on the event loop.
 @app.get("/session_history")
-async def get_session_history_endpoint(session_id: int = Query(..., description="Session ID")):
+def get_session_history_endpoint(session_id: int = Query(..., description="Session ID")):
     """
     Returns the session history for a given session_id.
     """
@@ -81,5 +97,28 @@ async def get_session_history_endpoint(session_id: int = Query(..., description=
             status_code=500, detail=f"Could not fetch session history: {str(e)}")
 
 
+@app.get("/jobs")
+def get_jobs_endpoint(session_id: int = Query(..., description="Session ID")):
+    """
+    Returns the generation jobs (and their artifacts) recorded for a given session_id.
+    """
+    try:
+        return {"session_id": session_id, "jobs": list_jobs(session_id)}
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Could not fetch jobs: {str(e)}")
+
+
+@app.get("/llm_stats")
+def get_llm_stats_endpoint():
+    """
+    Returns the LLM scheduler's queue depth, wait times and rate-limit bucket levels (across all workers).
+    """
+    return scheduler.stats()
+
+
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # WORKERS > 1 is safe: sessions, locks and artifacts are shared through shared_state.py.
+    workers = int(os.getenv("WORKERS", "1"))
+    uvicorn.run("main:app", host="0.0.0.0", port=8000,
+                reload=workers == 1, workers=workers)
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Sequence
+
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.chat_history import BaseChatMessageHistory
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# Shared state for running the API with several uvicorn workers.
+# Everything that has to be visible to every worker lives in one SQLite file (WAL mode),
+# per-session turn locks are `flock`s on small files next to it (released by the OS if a worker dies).
+
+TEMP_DIR = os.getenv("TEMP_DIR", "/tmp")
+SHARED_STATE_DB = os.getenv(
+    "SHARED_STATE_DB", os.path.join(TEMP_DIR, "ppt_shared_state.db"))
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", os.path.join(TEMP_DIR, "sessions"))
+LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "600"))
+# HTTP turns give up quickly (409) instead of holding a threadpool thread while the session is busy.
+HTTP_LOCK_TIMEOUT = float(os.getenv("HTTP_SESSION_LOCK_TIMEOUT", "2"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    topic TEXT,
+    artifact_path TEXT,
+    detail TEXT,
+    worker_pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id, job_id);
+
+-- LLM scheduler state (see llm_scheduler.py), so rate limits hold across all workers.
+CREATE TABLE IF NOT EXISTS llm_buckets (
+    name TEXT PRIMARY KEY,
+    level REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS llm_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    priority INTEGER NOT NULL,
+    worker_pid INTEGER NOT NULL,
+    enqueued_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_llm_queue_order ON llm_queue (priority, id);
+
+CREATE TABLE IF NOT EXISTS llm_stats (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+_initialized_db = None
+
+
+def _connect() -> sqlite3.Connection:
+    """Open a connection to the shared database, creating the schema on first use in this process."""
+    global _initialized_db
+    conn = sqlite3.connect(SHARED_STATE_DB, timeout=30,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout = 30000")
+    if _initialized_db != SHARED_STATE_DB:
+        os.makedirs(os.path.dirname(SHARED_STATE_DB) or ".", exist_ok=True)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(_SCHEMA)
+        _initialized_db = SHARED_STATE_DB
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
+@contextmanager
+def shared_db():
+    """Connection to the shared database (autocommit; use `BEGIN IMMEDIATE` for read-modify-write)."""
+    conn = _connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+# ## Session history:
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """Chat history of one session, stored in the shared SQLite database so every worker sees it."""
+
+    def __init__(self, session_id: str | int):
+        self.session_id = str(session_id)
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        with shared_db() as conn:
+            rows = conn.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY id",
+                (self.session_id,)).fetchall()
+        return messages_from_dict([json.loads(row["message"]) for row in rows])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        now = time.time()
+        rows = [(self.session_id, json.dumps(message_to_dict(msg)), now)
+                for msg in messages]
+        with shared_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO messages (session_id, message, created_at) VALUES (?, ?, ?)", rows)
+            conn.execute("COMMIT")
+
+    def clear(self) -> None:
+        with shared_db() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?",
+                         (self.session_id,))
+
+
+# ## Session locks:
+
+class SessionLockTimeout(TimeoutError):
+    """Raised when a session is still busy with another turn after the lock timeout."""
+
+
+def session_dir(session_id: str | int) -> str:
+    """Per-session working directory, shared by all workers."""
+    path = os.path.join(SESSIONS_DIR, str(int(session_id)))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def session_lock(session_id: str | int, timeout: float | None = None):
+    """Serialize turns of the same session across threads and worker processes.
+
+    Arguments:
+        session_id (str | int): The session to lock.
+        timeout (optional, float): Seconds to wait for the lock. Defaults to `LOCK_TIMEOUT`.
+    """
+    timeout = LOCK_TIMEOUT if timeout is None else timeout
+    lock_path = os.path.join(session_dir(session_id), ".lock")
+    deadline = time.monotonic() + timeout
+    with open(lock_path, "a") as f:
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise SessionLockTimeout(
+                        f"Session {session_id} is busy with another request.")
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# ## Job / artifact registry:
+
+def create_job(session_id: str | int, topic: str | None = None) -> int:
+    """Register a new agent turn for the session and return its job id."""
+    now = time.time()
+    with shared_db() as conn:
+        cur = conn.execute(
+            "INSERT INTO jobs (session_id, status, topic, worker_pid, created_at, updated_at) VALUES (?, 'running', ?, ?, ?, ?)",
+            (str(session_id), topic, os.getpid(), now, now))
+        return int(cur.lastrowid)  # type: ignore
+
+
+def update_job(job_id: int, status: str, artifact_path: str | None = None, detail: str | None = None) -> None:
+    """Set the status ("running" | "done" | "pending" | "failed") and optionally the artifact of a job."""
+    with shared_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, artifact_path = COALESCE(?, artifact_path), detail = COALESCE(?, detail), updated_at = ? WHERE job_id = ?",
+            (status, artifact_path, detail, time.time(), job_id))
+
+
+def get_job(job_id: int) -> dict | None:
+    with shared_db() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE job_id = ?",
+                           (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(session_id: str | int) -> List[dict]:
+    with shared_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE session_id = ? ORDER BY job_id",
+            (str(session_id),)).fetchall()
+    return [dict(row) for row in rows]
+
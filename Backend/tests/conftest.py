@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import shared_state  # noqa: E402
+
+
+@pytest.fixture
+def tmp_shared_state(tmp_path, monkeypatch):
+    """Point the shared state at a fresh database and sessions dir under `tmp_path`."""
+    db_path = str(tmp_path / "state.db")
+    sessions_dir = str(tmp_path / "sessions")
+    monkeypatch.setattr(shared_state, "SHARED_STATE_DB", db_path)
+    monkeypatch.setattr(shared_state, "SESSIONS_DIR", sessions_dir)
+    return db_path, sessions_dir
@@ -0,0 +1,256 @@
+import os
+import time
+import threading
+
+import pytest
+
+import llm_scheduler
+from llm_scheduler import LLMScheduler, TokenBudgetExceeded, llm_priority, deck_budget, call_with_retry, is_retryable
+from shared_state import shared_db, list_jobs
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeAPIError(Exception):
+    """Stands in for google.genai.errors.APIError, which carries the HTTP status as `code`."""
+
+    def __init__(self, code: int, message: str = ""):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+
+class FakeResult:
+    """Minimal LLMResult: one generation whose message reports `total_tokens`."""
+
+    def __init__(self, total_tokens: int):
+        message = type("Message", (), {"usage_metadata": {"total_tokens": total_tokens}})()
+        self.generations = [[type("Generation", (), {"message": message})()]]
+        self.llm_output = None
+
+
+def _drain_requests(scheduler: LLMScheduler, level: float) -> None:
+    with shared_db() as conn:
+        scheduler._set_level(conn, "requests", level, time.time())
+
+
+def test_interactive_calls_are_admitted_before_queued_batch_calls(tmp_shared_state):
+    scheduler = LLMScheduler(requests_per_minute=600)
+    _drain_requests(scheduler, -2)  # ~0.3s until the first call can go
+    order = []
+
+    def call(priority, name):
+        with llm_priority(priority):
+            scheduler.acquire()
+        order.append(name)
+
+    threads = [threading.Thread(target=call, args=("batch", f"batch{i}")) for i in range(2)]
+    for t in threads:
+        t.start()
+        time.sleep(0.02)
+    threads.append(threading.Thread(target=call, args=("interactive", "interactive")))
+    threads[-1].start()
+    time.sleep(0.05)
+    assert scheduler.stats()["queue_depth_by_priority"] == {"interactive": 1, "batch": 2}
+
+    for t in threads:
+        t.join(timeout=10)
+    assert order == ["interactive", "batch0", "batch1"]
+    stats = scheduler.stats()
+    assert stats["queue_depth"] == 0 and stats["admitted"] == 3
+    assert stats["worker_pid"] == os.getpid()
+
+
+def test_only_the_head_of_the_queue_takes_the_write_lock(tmp_shared_state, monkeypatch):
+    scheduler = LLMScheduler(requests_per_minute=600)
+    _drain_requests(scheduler, -1)  # ~0.2s until the first call can go
+    attempts = []
+    try_admit = scheduler._try_admit
+
+    def recording_try_admit(entry_id, start, reserve):
+        admitted, wait, is_head = try_admit(entry_id, start, reserve)
+        attempts.append(is_head)
+        return admitted, wait, is_head
+
+    monkeypatch.setattr(scheduler, "_try_admit", recording_try_admit)
+    threads = [threading.Thread(target=scheduler.acquire) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    assert scheduler.stats()["admitted"] == 4
+    assert attempts and all(attempts)
+    # The head sleeps until the bucket refills rather than retrying every poll interval.
+    assert len(attempts) < 20
+
+
+def test_token_debt_delays_the_next_call(tmp_shared_state):
+    scheduler = LLMScheduler(tokens_per_minute=6000, tokens_per_call=0)  # refills 100 tokens/s
+    scheduler.acquire()
+    scheduler.record_usage(6050)  # 50 tokens of debt
+
+    start = time.monotonic()
+    scheduler.acquire()
+    assert time.monotonic() - start >= 0.4
+    assert scheduler.stats()["tokens_used"] == 6050
+
+
+def test_burst_is_spread_out_by_reserved_tokens(tmp_shared_state):
+    # Refills 100 tokens/s and every call reserves 20, so an empty bucket admits one call per ~0.2s.
+    scheduler = LLMScheduler(requests_per_minute=600, tokens_per_minute=6000, tokens_per_call=20)
+    with shared_db() as conn:
+        scheduler._set_level(conn, "tokens", 0, time.time())
+    admitted_at = []
+    start = time.monotonic()
+
+    def call():
+        scheduler.acquire()
+        admitted_at.append(time.monotonic() - start)
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    assert len(admitted_at) == 5
+    assert sorted(admitted_at)[-1] >= 0.8
+    gaps = [b - a for a, b in zip(sorted(admitted_at), sorted(admitted_at)[1:])]
+    assert all(gap >= 0.1 for gap in gaps)
+
+
+def test_usage_callback_replaces_the_reservation_with_real_usage(tmp_shared_state):
+    scheduler = LLMScheduler(tokens_per_minute=60000)
+    callback = llm_scheduler.TokenUsageCallback(scheduler)
+
+    # ~4000 chars of prompt -> 1000 tokens plus the expected output.
+    callback.on_chat_model_start({}, [[FakeMessage("x" * 4000)]])
+    scheduler.acquire()
+    reserved = 1000 + llm_scheduler.LLM_OUTPUT_TOKEN_ESTIMATE
+    assert scheduler.stats()["tokens_available"] == pytest.approx(60000 - reserved, abs=50)
+
+    callback.on_llm_end(FakeResult(total_tokens=1500))
+    stats = scheduler.stats()
+    assert stats["tokens_available"] == pytest.approx(60000 - 1500, abs=50)
+    assert stats["tokens_used"] == 1500
+
+
+def test_failed_call_returns_its_reservation(tmp_shared_state):
+    scheduler = LLMScheduler(tokens_per_minute=60000, tokens_per_call=5000)
+    callback = llm_scheduler.TokenUsageCallback(scheduler)
+
+    scheduler.acquire()
+    callback.on_llm_error(FakeAPIError(429))
+    assert scheduler.stats()["tokens_available"] == pytest.approx(60000, abs=50)
+
+
+def test_non_blocking_acquire_does_not_wait_or_stay_queued(tmp_shared_state):
+    scheduler = LLMScheduler(requests_per_minute=60)
+    _drain_requests(scheduler, 0)
+
+    assert scheduler.acquire(blocking=False) is False
+    assert scheduler.stats()["queue_depth"] == 0
+
+
+def test_deck_budget_stops_further_calls(tmp_shared_state):
+    scheduler = LLMScheduler()
+    with deck_budget(100) as budget:
+        scheduler.acquire()
+        scheduler.record_usage(150)
+        assert budget.used == 150
+        with pytest.raises(TokenBudgetExceeded):
+            scheduler.acquire()
+    assert scheduler.stats()["budget_stops"] == 1
+
+
+@pytest.mark.parametrize("error, expected", [
+    (FakeAPIError(429, "RESOURCE_EXHAUSTED"), True),
+    (FakeAPIError(503, "UNAVAILABLE"), True),
+    (FakeAPIError(400, "INVALID_ARGUMENT"), False),
+    (TimeoutError("read timed out"), True),
+    (ValueError("Slide about the Fortune 500 failed validation"), False),
+    (RuntimeError("Request timeout while quoting a deadline"), False),
+    (TokenBudgetExceeded("used up"), False),
+])
+def test_is_retryable(error, expected):
+    assert is_retryable(error) is expected
+
+
+def test_is_retryable_looks_through_wrapped_errors():
+    try:
+        try:
+            raise FakeAPIError(429)
+        except FakeAPIError as e:
+            raise RuntimeError("Error calling model") from e
+    except RuntimeError as wrapped:
+        assert is_retryable(wrapped)
+
+
+def test_call_with_retry_retries_only_retryable_errors(tmp_shared_state, monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "LLM_RETRY_BASE_DELAY", 0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise FakeAPIError(429)
+        return "ok"
+
+    assert call_with_retry(flaky) == "ok"
+    assert len(calls) == 3
+    assert llm_scheduler.scheduler.stats()["retries"] == 2
+
+    calls.clear()
+
+    def broken():
+        calls.append(1)
+        raise ValueError("Fortune 500")
+
+    with pytest.raises(ValueError):
+        call_with_retry(broken)
+    assert len(calls) == 1
+
+    calls.clear()
+
+    def down():
+        calls.append(1)
+        raise FakeAPIError(503)
+
+    with pytest.raises(FakeAPIError):
+        call_with_retry(down, max_retries=2)
+    assert len(calls) == 3
+
+
+@pytest.fixture
+def agents(tmp_shared_state, monkeypatch):
+    monkeypatch.setenv("GOOGLE_API_KEY", "test-key")
+    monkeypatch.chdir(BACKEND_DIR)  # agents.py loads pptx_docs/ relative to the working directory
+    import agents
+    return agents
+
+
+def test_budget_exhaustion_ends_the_turn(agents, monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "DECK_TOKEN_BUDGET", 1000)
+
+    class ExpensiveAgent:
+        # Each model call costs more than the whole deck budget, so the second call is refused.
+        def invoke(self, input, verbose=False):
+            for _ in range(5):
+                agents.scheduler.acquire()
+                agents.scheduler.record_usage(1500)
+            raise AssertionError("the budget should have stopped the agent")
+
+    monkeypatch.setattr(agents, "ppt_maker_agent", ExpensiveAgent())
+
+    result, job_id = agents.ask_something(5, "Make a deck about oceans")
+
+    assert result.ppt_generated is False
+    assert "budget" in result.content
+    job = list_jobs(5)[-1]
+    assert job["job_id"] == job_id and job["status"] == "failed"
+    assert [m["role"] for m in agents.get_chat_history(5)] == ["human", "ai"]
@@ -0,0 +1,99 @@
+import time
+import multiprocessing
+
+import pytest
+
+from langchain_core.messages import HumanMessage, AIMessage
+
+import shared_state
+from shared_state import SQLiteChatMessageHistory, SessionLockTimeout, session_lock, create_job, update_job, list_jobs
+
+
+def _worker_turns(db_path: str, sessions_dir: str, session_id: int, turns: int, hold: float, barrier) -> None:
+    # Simulates a uvicorn worker: every turn reads the history and appends a human/ai pair under the session lock.
+    shared_state.SHARED_STATE_DB = db_path
+    shared_state.SESSIONS_DIR = sessions_dir
+    history = SQLiteChatMessageHistory(session_id)
+    barrier.wait()
+    for i in range(turns):
+        with session_lock(session_id):
+            job_id = create_job(session_id, topic=f"turn {i}")
+            n = len(history.messages)
+            time.sleep(hold)  # stands in for the agent call
+            history.add_messages([HumanMessage(content=f"{n}"),
+                                  AIMessage(content=f"{n + 1}")])
+            update_job(job_id, "done")
+
+
+def _run_workers(tmp_shared_state, session_ids, turns, hold=0.0):
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(len(session_ids))
+    procs = [ctx.Process(target=_worker_turns, args=(*tmp_shared_state, session_id, turns, hold, barrier))
+             for session_id in session_ids]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(timeout=120)
+    assert all(p.exitcode == 0 for p in procs), "A worker process failed."
+
+
+def _turn_span(session_ids):
+    jobs = [job for session_id in set(session_ids) for job in list_jobs(session_id)]
+    return max(job["updated_at"] for job in jobs) - min(job["created_at"] for job in jobs)
+
+
+def test_history_round_trip(tmp_shared_state):
+    history = SQLiteChatMessageHistory(3)
+    history.add_user_message("make a deck")
+    history.add_ai_message("how many slides?")
+
+    # A fresh instance (as on another worker) sees the same messages.
+    msgs = SQLiteChatMessageHistory(3).messages
+    assert [(type(m), m.content) for m in msgs] == [
+        (HumanMessage, "make a deck"), (AIMessage, "how many slides?")]
+    assert SQLiteChatMessageHistory(4).messages == []
+
+
+def test_same_session_turns_are_serialized_across_processes(tmp_shared_state):
+    workers, turns = 4, 10
+    _run_workers(tmp_shared_state, [1] * workers + [2] * workers, turns)
+
+    for session_id in (1, 2):
+        msgs = SQLiteChatMessageHistory(session_id).messages
+        assert len(msgs) == 2 * workers * turns
+        # Each turn must see the message count left by the previous one, i.e. turns never overlapped.
+        assert [int(str(m.content)) for m in msgs] == list(range(len(msgs)))
+        jobs = list_jobs(session_id)
+        assert len(jobs) == workers * turns
+        assert all(job["status"] == "done" for job in jobs)
+
+
+def test_different_sessions_run_in_parallel(tmp_shared_state):
+    workers, turns, hold = 4, 3, 0.3
+    session_ids = list(range(10, 10 + workers))
+    _run_workers(tmp_shared_state, session_ids, turns, hold)
+
+    for session_id in session_ids:
+        assert len(SQLiteChatMessageHistory(session_id).messages) == 2 * turns
+        assert len(list_jobs(session_id)) == turns
+    # Serialized, the turns would take workers * turns * hold; with one session per process they overlap.
+    assert _turn_span(session_ids) < workers * turns * hold / 2
+
+
+def test_same_session_does_not_scale_with_workers(tmp_shared_state):
+    workers, turns, hold = 4, 1, 0.2
+    _run_workers(tmp_shared_state, [20] * workers, turns, hold)
+
+    assert _turn_span([20]) >= workers * turns * hold
+
+
+def test_busy_session_times_out_early(tmp_shared_state):
+    with session_lock(30):
+        start = time.monotonic()
+        with pytest.raises(SessionLockTimeout):
+            with session_lock(30, timeout=0.2):
+                pass
+        assert time.monotonic() - start < 1
+    # Released again once the running turn is done.
+    with session_lock(30, timeout=0.2):
+        pass